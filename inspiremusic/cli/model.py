@@ -63,7 +63,7 @@ class InspireMusicModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = 34
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
+        self.mel_window = torch.from_numpy(np.hamming(2 * self.mel_overlap_len)).float().to(self.device)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
@@ -83,6 +83,7 @@ class InspireMusicModel:
         if llm_model is not None:
             self.llm.load_state_dict(torch.load(llm_model, map_location=self.device, weights_only=True))
             self.llm.to(self.device).to(self.dtype).eval()
+            self.llm.setup_sampling(self.device)
         else:
             self.llm = None
         if flow_model is not None:
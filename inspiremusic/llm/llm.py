@@ -11,13 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Union
+import functools
+import inspect
 import torch
 from torch import nn
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from inspiremusic.utils.common import IGNORE_ID
 from inspiremusic.transformer.label_smoothing_loss import LabelSmoothingLoss
 from inspiremusic.utils.common import th_accuracy
+from inspiremusic.utils.common import History
+from inspiremusic.utils.common import compile_nucleus_filter
 from torch import Tensor
 from math import log
 from einops import rearrange, reduce, repeat
@@ -103,6 +107,10 @@ class LLM(torch.nn.Module):
         self.num_codebooks = 4
         # 4. sampling method
         self.sampling = sampling
+        # seed of the per-decode sampling generator, None uses the global RNG
+        self.sampling_seed = kwargs.get("sampling_seed", None)
+        # opt-in CUDA graph for the nucleus filter, see setup_sampling
+        self.compile_sampling = kwargs.get("compile_sampling", False)
         self.time_embedding = SinusoidalEmbedding(llm_input_size)
 
     def cfg_dropout(self, text_token, text_token_len, p):
@@ -263,13 +271,49 @@ class LLM(torch.nn.Module):
 
         return {'loss': loss, 'acc': acc}
 
+    def setup_sampling(self, device: torch.device):
+        """Compile the nucleus filter of the configured sampler for `device`.
+
+        Only runs when compile_sampling is set, the device is CUDA and the
+        sampler takes a nucleus_filter (nucleus / ras / caras sampling).
+        Called once after the model is moved to its device, so compilation
+        happens before decoding rather than on the first token.
+        """
+        if not self.compile_sampling or torch.device(device).type != 'cuda':
+            return
+        params = inspect.signature(self.sampling).parameters
+        if 'nucleus_filter' not in params:
+            logging.info("compile_sampling ignored, the sampler has no nucleus filter")
+            return
+        nucleus_filter = compile_nucleus_filter(self.audio_token_size + 1,
+                                                params['top_p'].default,
+                                                params['top_k'].default,
+                                                device)
+        if nucleus_filter is not None:
+            self.sampling = functools.partial(self.sampling, nucleus_filter=nucleus_filter)
+
+    def sampling_uses_history(self) -> bool:
+        # only the repetition aware samplers read decoded_tokens
+        return 'win_size' in inspect.signature(self.sampling).parameters
+
+    def sampling_generator(self, device: torch.device) -> Optional[torch.Generator]:
+        # a fresh generator per decode, so that every inference call with the
+        # same sampling_seed draws the same tokens regardless of global RNG use
+        if self.sampling_seed is None:
+            return None
+        return torch.Generator(device=device).manual_seed(self.sampling_seed)
+
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, torch.Tensor, History],
             ignore_eos: bool = True,
+            generator: Optional[torch.Generator] = None,
     ):
-        top_ids = self.sampling(weighted_scores, decoded_tokens)
+        if generator is None:
+            top_ids = self.sampling(weighted_scores, decoded_tokens)
+        else:
+            top_ids = self.sampling(weighted_scores, decoded_tokens, generator=generator)
         return top_ids
 
     @torch.inference_mode()
@@ -351,9 +395,11 @@ class LLM(torch.nn.Module):
         max_len = duration_to_gen * token_rate
 
         # 5. step by step decode
-        out_tokens = []
+        # keep the decoded tokens on device only for samplers that read them
+        out_tokens = History(int(max_len), device=device) if self.sampling_uses_history() else []
         offset = 0
         state = None
+        generator = self.sampling_generator(device)
 
         for i in range(int(max_len)):
             y_pred, _, state = self.llm.forward_one_step(lm_input.to(self.dtype), torch.ones(lm_input.shape[0], lm_input.shape[1], device=lm_input.device).to(torch.bool), cache=state)
@@ -371,7 +417,7 @@ class LLM(torch.nn.Module):
             if i < int(min_len):
                 logp[self.audio_token_size] = torch.tensor(float('-inf'), dtype=self.dtype)
 
-            top_ids = self.sampling_ids(logp, out_tokens, ignore_eos=i < min_len).item()
+            top_ids = self.sampling_ids(logp, out_tokens, ignore_eos=i < min_len, generator=generator).item()
 
             if top_ids == self.audio_token_size:
                 break
@@ -467,12 +513,13 @@ class LLM(torch.nn.Module):
         logging.info(f"LLM generation sequence length: {max_len}, generate audio length {duration_to_gen}s.")
 
         # 5. step by step decode
-        out_tokens = []
+        out_tokens = History(max_len, device=lm_input.device, batch_size=batch_size)
         offset = 0
         state = None
         cfg_state = None
 
-        stop_mask = [False for _ in range(batch_size)]
+        stop_mask = torch.zeros(batch_size, dtype=torch.bool, device=lm_input.device)
+        generator = self.sampling_generator(lm_input.device)
 
         for i in range(max_len):
             y_pred,_, state = self.llm.forward_one_step(lm_input,torch.ones(lm_input.shape[0], lm_input.shape[1],
@@ -490,24 +537,15 @@ class LLM(torch.nn.Module):
             logp = logits.log_softmax(dim=-1)
             if i < min_len:
                 logp[:,self.audio_token_size] = float("-inf")
-            top_ids = []
-            for j in range(batch_size):
-                if stop_mask[j] or i + min_text_len < lm_input_len[j]:
-                    _top_id = torch.LongTensor([0]).to(logp.device)
-                else:
-                    if len(out_tokens)>0:
-                        _top_id = self.sampling_ids(logp[j], out_tokens[j], ignore_eos= i < min_len)
-                    else:
-                        _top_id = self.sampling_ids(logp[j], [], ignore_eos= i < min_len)
-
-                if _top_id == self.audio_token_size:
-
-                    stop_mask[j] = True
-                    _top_id = torch.LongTensor([0]).to(logp.device)
-                top_ids.append(_top_id)
-            if all(stop_mask):
-                return out_tokens
-            top_ids = torch.cat(top_ids,0)
+            # sample the whole batch at once, then blank out the rows that are
+            # still consuming their prompt or have already emitted eos
+            top_ids = self.sampling_ids(logp, out_tokens, ignore_eos= i < min_len, generator=generator).squeeze(-1)
+            inactive = stop_mask | (i + min_text_len < lm_input_len[:batch_size])
+            is_eos = ~inactive & (top_ids == self.audio_token_size)
+            stop_mask = stop_mask | is_eos
+            top_ids = top_ids.masked_fill(inactive | is_eos, 0)
+            if stop_mask.all():
+                return out_tokens.tokens()
             top_ids_embed = self.speech_embedding.weight[top_ids][:,None,:].repeat(2,1,1)
 
             if i + min_text_len >= lm_input_orig.size(1):
@@ -515,9 +553,6 @@ class LLM(torch.nn.Module):
             else:
                 lm_input = torch.where((lm_input_len>=min_text_len + i)[:,None], lm_input_orig[:,min_text_len + i],top_ids_embed.squeeze(1))[:,None]
 
-            if len(out_tokens)>0:
-                out_tokens = torch.cat([out_tokens,top_ids[:,None]],1)
-            else:
-                out_tokens = top_ids[:,None]
+            out_tokens.append(top_ids)
 
-        return out_tokens
\ No newline at end of file
+        return out_tokens.tokens()
\ No newline at end of file
@@ -15,16 +15,22 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Unility functions for Transformer."""
 
-from typing import List
+from typing import List, Optional
+import logging
+import random
+import numpy as np
 import torch
 IGNORE_ID = -1
 
-def pad_list(xs: List[torch.Tensor], pad_value: int):
+def pad_list(xs: List[torch.Tensor], pad_value: int,
+             pad_to_multiple_of: int = 1):
     """Perform padding for the list of tensors.
 
     Args:
         xs (List): List of Tensors [(T_1, `*`), (T_2, `*`), ..., (T_B, `*`)].
         pad_value (float): Value for padding.
+        pad_to_multiple_of (int): Round Tmax up to a multiple of this value,
+            e.g. 8 for fp16 / 16 for bf16 to keep Tensor Core friendly shapes.
 
     Returns:
         Tensor: Padded tensor (B, Tmax, `*`).
@@ -39,32 +45,37 @@ def pad_list(xs: List[torch.Tensor], pad_value: int):
                 [1., 0., 0., 0.]])
 
     """
-    max_len = max([len(item) for item in xs])
+    assert pad_to_multiple_of >= 1, \
+        f"pad_to_multiple_of should be >= 1, got {pad_to_multiple_of}"
+    return _pad_list(list(xs), float(pad_value), pad_to_multiple_of)
+
+
+@torch.jit.script
+def _pad_list(xs: List[torch.Tensor], pad_value: float,
+              pad_to_multiple_of: int) -> torch.Tensor:
+    # scripted so that the length bookkeeping around the padding kernel
+    # does not go through the python interpreter on every minibatch
+    lengths = [x.size(0) for x in xs]
     batchs = len(xs)
-    ndim = xs[0].ndim
-    if ndim == 1:
-        pad_res = torch.zeros(batchs,
-                              max_len,
-                              dtype=xs[0].dtype,
-                              device=xs[0].device)
-    elif ndim == 2:
-        pad_res = torch.zeros(batchs,
-                              max_len,
-                              xs[0].shape[1],
-                              dtype=xs[0].dtype,
-                              device=xs[0].device)
-    elif ndim == 3:
-        pad_res = torch.zeros(batchs,
-                              max_len,
-                              xs[0].shape[1],
-                              xs[0].shape[2],
-                              dtype=xs[0].dtype,
-                              device=xs[0].device)
-    else:
-        raise ValueError(f"Unsupported ndim: {ndim}")
-    pad_res.fill_(pad_value)
-    for i in range(batchs):
-        pad_res[i, :len(xs[i])] = xs[i]
+    total_len = sum(lengths)
+    max_len = max(lengths)
+    padded_len = (max_len + pad_to_multiple_of - 1) \
+        // pad_to_multiple_of * pad_to_multiple_of
+    tail = xs[0].shape[1:]
+    device = xs[0].device
+    pad_res = torch.full([batchs, padded_len] + tail, pad_value,
+                         dtype=xs[0].dtype, device=device)
+    # flat row index of every frame in the padded output: frame t of item i
+    # lands at i * padded_len + t, so all items are copied in one scatter
+    lens = torch.tensor(lengths, dtype=torch.long, device=device)
+    offsets = torch.arange(batchs, dtype=torch.long, device=device) * padded_len \
+        - (lens.cumsum(0) - lens)
+    index = torch.arange(total_len, dtype=torch.long, device=device) \
+        + offsets.repeat_interleave(lens, dim=0, output_size=total_len)
+    # cat promotes mixed-dtype items while index_copy_ needs an exact match;
+    # cast back to the output dtype as the per-item slice assignment did
+    pad_res.view([batchs * padded_len] + tail).index_copy_(
+        0, index, torch.cat(xs, dim=0).to(pad_res.dtype))
     return pad_res
 
 
@@ -81,11 +92,10 @@ def th_accuracy(pad_outputs: torch.Tensor, pad_targets: torch.Tensor,
         torch.Tensor: Accuracy value (0.0 - 1.0).
 
     """
-    pad_pred = pad_outputs.view(pad_targets.size(0), pad_targets.size(1),
-                                pad_outputs.size(1)).argmax(2)
+    pad_pred = pad_outputs.argmax(dim=-1).view(pad_targets.size(0),
+                                               pad_targets.size(1))
     mask = pad_targets != ignore_label
-    numerator = torch.sum(
-        pad_pred.masked_select(mask) == pad_targets.masked_select(mask))
+    numerator = torch.sum((pad_pred == pad_targets) & mask)
     denominator = torch.sum(mask)
     return (numerator / denominator).detach()
 
@@ -110,27 +120,29 @@ def keep_harmony(next_token, current_chord):
     return next_token
 
 def relieve_repetition(weighted_scores, recent_tokens, repetition_penalty=1.2):
-    for token in recent_tokens:
-        if weighted_scores[token] > 0:
-            weighted_scores[token] /= repetition_penalty
+    # a positive score of a token seen n times is divided by
+    # repetition_penalty ** n, as the sequential per-occurrence loop did
+    tokens, counts = torch.as_tensor(recent_tokens, dtype=torch.long,
+                                     device=weighted_scores.device).unique(return_counts=True)
+    scores = weighted_scores.index_select(0, tokens)
+    penalty = torch.pow(repetition_penalty, counts).to(scores)
+    scores = torch.where(scores > 0, scores / penalty, scores)
+    weighted_scores.index_copy_(0, tokens, scores)
     return weighted_scores
 
-def top_p_sampling_with_constraints(weighted_scores, decoded_tokens, top_p=0.85, temperature=1.1, current_chord=None, current_time_signature=None, recent_tokens=None):
-    # Apply temperature scaling
-    weighted_scores = weighted_scores ** (1 / temperature)
-    weighted_scores /= weighted_scores.sum()
+def top_p_sampling_with_constraints(weighted_scores, decoded_tokens, top_p=0.85, temperature=1.1, current_chord=None, current_time_signature=None, recent_tokens=None, generator=None):
+    # Apply temperature scaling in log-space, softmax(log(p) / T), which is
+    # p ** (1 / T) renormalized without the overflow-prone pow
+    weighted_scores = (weighted_scores.log() / temperature).softmax(dim=0)
 
     if recent_tokens:
         weighted_scores = relieve_repetition(weighted_scores, recent_tokens)
 
-    # Sort weighted scores in descending order
-    sorted_weighted_scores, _ = torch.sort(weighted_scores, descending=True)
-
-    # Compute cumulative weighted scores
-    cumulative_weighted_scores = torch.cumsum(sorted_weighted_scores, dim=0)
+    # Sort weighted scores in descending order and accumulate them
+    sorted_weighted_scores, sorted_idx, cumulative_weighted_scores = _sorted_cumsum(weighted_scores)
 
     # Find the threthold index of top-p
-    cutoff_index = torch.where(cumulative_weighted_scores >= top_p)[0][0]
+    cutoff_index = torch.searchsorted(cumulative_weighted_scores, top_p)
     selected_weighted_scores = sorted_weighted_scores[:cutoff_index + 1]
 
     # Apply domain-specific constraints
@@ -143,60 +155,166 @@ def top_p_sampling_with_constraints(weighted_scores, decoded_tokens, top_p=0.85,
     selected_weighted_scores /= selected_weighted_scores.sum()
 
     # Sample top-p tokens from the distribution
-    return random_sampling(selected_weighted_scores, decoded_tokens)
-def topk_sampling(weighted_scores, decoded_tokens, top_k=25):
-    zeros = weighted_scores.new_ones(weighted_scores.shape) * float('-inf')
-    values,indices =  torch.topk(weighted_scores,top_k)
-    zeros.scatter_(-1, indices, values)
-    return random_sampling(zeros,decoded_tokens)
+    return sorted_idx[random_sampling_from_probs(selected_weighted_scores, decoded_tokens, generator=generator)]
+
+def _sorted_cumsum(probs, top_k=None):
+    # shared by the top-p samplers: descending sort of probs along the last
+    # dim (optionally truncated to top_k) and its cumulative sum
+    if top_k is not None:
+        # only the top_k candidates can be kept, so select them instead of
+        # sorting the whole vocab; topk already returns them in descending order
+        sorted_value, sorted_idx = probs.topk(min(top_k, probs.size(-1)), dim=-1)
+    else:
+        sorted_value, sorted_idx = probs.sort(dim=-1, descending=True, stable=True)
+    return sorted_value, sorted_idx, sorted_value.cumsum(dim=-1)
 
-# Repetition Aware Sampling in VALL-E 2
+class History:
+    """Device-resident buffer of decoded tokens.
+
+    Preallocated once per decode, so repetition aware samplers can read the
+    recent window as a view instead of rebuilding a tensor from a python
+    list and copying it to the device on every token.
+    """
 
-def ras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens)
+    def __init__(self, max_len: int, device: Optional[torch.device] = None,
+                 batch_size: Optional[int] = None):
+        shape = (max_len,) if batch_size is None else (batch_size, max_len)
+        self.buf = torch.full(shape, -1, dtype=torch.long, device=device)
+        self.pos = 0
+
+    def append(self, token):
+        assert self.pos < self.buf.size(-1), \
+            f"History is full, max_len {self.buf.size(-1)}"
+        self.buf[..., self.pos] = token
+        self.pos += 1
+
+    def recent(self, win_size: int) -> torch.Tensor:
+        return self.buf[..., max(0, self.pos - win_size):self.pos]
+
+    def tokens(self) -> torch.Tensor:
+        return self.buf[..., :self.pos]
+
+    def __len__(self):
+        return self.pos
+
+def _recent_tokens(decoded_tokens, win_size, device):
+    # decoded_tokens is a History, a python list or a (T,) / (B, T) device
+    # tensor (batch inference); only the list needs a host to device copy.
+    if isinstance(decoded_tokens, History):
+        return decoded_tokens.recent(win_size)
+    if isinstance(decoded_tokens, torch.Tensor):
+        return decoded_tokens[..., -win_size:].to(device=device, dtype=torch.long)
+    return torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=device)
+
+# NOTE: the samplers below accept scores of shape (V,) or (B, V) and return
+# token ids shaped like multinomial's output, i.e. (1,) or (B, 1).
+
+def topk_sampling(weighted_scores, decoded_tokens, top_k=25, generator=None):
+    values, indices = torch.topk(weighted_scores, top_k)
+    top_ids = indices.gather(-1, random_sampling(values, decoded_tokens, generator=generator))
     return top_ids
 
-def caras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+# Repetition Aware Sampling in VALL-E 2
+
+def _resample_repeated(replace, top_ids, weighted_scores, decoded_tokens, generator=None):
+    if weighted_scores.dim() == 1:
+        # streaming decode .item()s every token anyway, so branching on the
+        # host costs no extra sync and only draws the fallback when needed
+        if replace:
+            top_ids = random_sampling(weighted_scores, decoded_tokens, generator=generator)
+        return top_ids
+    # batched: always draw the fallback and select per row on device. This
+    # spends a softmax + multinomial (and RNG draws) every step, even without
+    # repetition, to avoid a host sync on the repetition counts.
+    return torch.where(replace, random_sampling(weighted_scores, decoded_tokens, generator=generator), top_ids)
+
+def ras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, generator=None, nucleus_filter=None):
+    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k, generator=generator, nucleus_filter=nucleus_filter)
+    rep_num = (_recent_tokens(decoded_tokens, win_size, weighted_scores.device) == top_ids).sum(dim=-1, keepdim=True)
+    return _resample_repeated(rep_num >= win_size * tau_r, top_ids, weighted_scores, decoded_tokens, generator)
+
+def caras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, generator=None, nucleus_filter=None):
     weighted_scores, cfg_weighted_scores = weighted_scores
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(cfg_weighted_scores, decoded_tokens)
-    return top_ids
+    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k, generator=generator, nucleus_filter=nucleus_filter)
+    rep_num = (_recent_tokens(decoded_tokens, win_size, weighted_scores.device) == top_ids).sum(dim=-1, keepdim=True)
+    return _resample_repeated(rep_num >= win_size * tau_r, top_ids, cfg_weighted_scores, decoded_tokens, generator)
+
+def _nucleus_filter(weighted_scores, top_p, top_k: int):
+    sorted_value, sorted_idx, cum_prob = _sorted_cumsum(weighted_scores.softmax(dim=-1), top_k)
+    # sampling both top-p and numbers: keep a token while the probability
+    # mass accumulated before it is still below top_p.
+    prob = sorted_value.masked_fill(cum_prob - sorted_value >= top_p, 0.0)
+    return prob, sorted_idx
+
+def compile_nucleus_filter(vocab_size: int, top_p: float, top_k: int,
+                           device: torch.device,
+                           dtype: torch.dtype = torch.float32):
+    """Compile the nucleus filter into a CUDA graph for 1-D scores.
+
+    The graph is specialized on vocab_size, top_k and dtype and compiled
+    and recorded here, up front, so no decoding step waits for inductor.
+    top_p is fed to the graph as a 0-dim tensor rather than baked into it.
+    Scores of any other shape (e.g. batch_inference) or sampling settings
+    fall back to the eager filter instead of triggering a recompile.
 
-def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+    Returns:
+        Callable with the signature of _nucleus_filter, or None when
+        torch.compile / inductor is not usable in this environment.
+    """
+    try:
+        compiled = torch.compile(_nucleus_filter, mode="reduce-overhead",
+                                 fullgraph=True, dynamic=False)
+        top_p_tensor = torch.tensor(top_p, dtype=torch.float32, device=device)
+        scores = torch.zeros(vocab_size, dtype=dtype, device=device)
+        # the first calls compile the graph and record the CUDA graph
+        for _ in range(3):
+            compiled(scores, top_p_tensor, top_k)
+        torch.cuda.synchronize(device)
+    except (ImportError, RuntimeError) as e:
+        # dynamo / inductor / triton unavailable, e.g. torch 2.0 on
+        # python 3.11+ or windows; BackendCompilerFailed is a RuntimeError
+        logging.warning(f"compiling nucleus sampling failed, sampling eagerly: {e}")
+        return None
+
+    settings = (top_p, top_k)
+
+    def nucleus_filter(weighted_scores, top_p, top_k):
+        if (top_p, top_k) == settings and weighted_scores.shape == scores.shape \
+                and weighted_scores.dtype == scores.dtype \
+                and weighted_scores.device == scores.device:
+            return compiled(weighted_scores, top_p_tensor, top_k)
+        return _nucleus_filter(weighted_scores, top_p, top_k)
+
+    return nucleus_filter
+
+def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25, generator=None, nucleus_filter=None):
+    if nucleus_filter is None:
+        nucleus_filter = _nucleus_filter
+    prob, sorted_idx = nucleus_filter(weighted_scores, top_p, top_k)
+    top_ids = sorted_idx.gather(-1, prob.multinomial(1, replacement=True, generator=generator))
     return top_ids
 
 
-def random_sampling(weighted_scores, decoded_tokens):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+def random_sampling(weighted_scores, decoded_tokens, generator=None):
+    return random_sampling_from_probs(weighted_scores.softmax(dim=-1), decoded_tokens, generator=generator)
+
+
+def random_sampling_from_probs(probs, decoded_tokens, generator=None):
+    # for callers whose scores are already a (possibly unnormalized)
+    # distribution, which saves a softmax over the candidates
+    top_ids = probs.multinomial(1, replacement=True, generator=generator)
     return top_ids
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
-    mel_overlap_len = int(window.shape[0] / 2)
-    fade_in_mel[:, :, :mel_overlap_len] = fade_in_mel[:, :, :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[:, :, -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    mel_overlap_len = window.shape[0] // 2
+    # no-op for a window already on the mel's device and dtype, see
+    # InspireMusicModel.mel_window; still accepts a numpy window
+    window = torch.as_tensor(window, dtype=fade_in_mel.dtype, device=fade_in_mel.device)
+    # blend only the overlap and leave the caller's tensor untouched
+    fade_mel = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
+        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
+    return torch.cat([fade_mel, fade_in_mel[..., mel_overlap_len:]], dim=-1)
 
 def set_all_random_seed(seed):
     random.seed(seed)
@@ -207,9 +325,11 @@ def set_all_random_seed(seed):
 def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     assert mask.dtype == torch.bool
     assert dtype in [torch.float32, torch.bfloat16, torch.float16]
-    mask = mask.to(dtype)
     # attention mask bias
     # NOTE(Mddct): torch.finfo jit issues
     #     chunk_masks = (1.0 - chunk_masks) * torch.finfo(dtype).min
-    mask = (1.0 - mask) * torch.finfo(dtype).min
-    return mask
\ No newline at end of file
+    # select 0 / finfo.min in one pass instead of cast, sub and mul
+    zero = torch.zeros((), dtype=dtype, device=mask.device)
+    neg_inf = torch.full((), torch.finfo(dtype).min, dtype=dtype, device=mask.device)
+    mask = torch.where(mask, zero, neg_inf)
+    return mask